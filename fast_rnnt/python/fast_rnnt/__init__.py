@@ -6,6 +6,7 @@ from .mutual_information import joint_mutual_information_recursion
 from .rnnt_loss import do_rnnt_pruning
 from .rnnt_loss import get_rnnt_logprobs
 from .rnnt_loss import get_rnnt_logprobs_joint
+from .rnnt_loss import get_rnnt_logprobs_joint_samplewise
 from .rnnt_loss import get_rnnt_logprobs_pruned
 from .rnnt_loss import get_rnnt_logprobs_smoothed
 from .rnnt_loss import get_rnnt_prune_ranges
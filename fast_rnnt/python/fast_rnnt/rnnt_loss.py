@@ -14,13 +14,84 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import os
 
 import torch
 from torch import Tensor
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 from .mutual_information import mutual_information_recursion
 
+# torch.compile() is opt-in (and only available in torch >= 2.0):
+#   FAST_RNNT_COMPILE=1 compiles the private helpers with dynamic shapes;
+#   FAST_RNNT_COMPILE=static compiles them, and the public get_rnnt_logprobs*
+#   functions, with static shapes and mode="max-autotune-no-cudagraphs".
+# Otherwise (the default) everything runs in eager mode.
+_compile_mode = os.environ.get("FAST_RNNT_COMPILE", "0")
+if _compile_mode not in ("0", "1", "static"):
+    raise ValueError(
+        "FAST_RNNT_COMPILE should be ('0' | '1' | 'static'), "
+        f"given {_compile_mode}"
+    )
+_use_torch_compile = hasattr(torch, "compile") and _compile_mode != "0"
+_use_static_compile = _use_torch_compile and _compile_mode == "static"
+
+if _use_torch_compile:
+    import torch._dynamo
+
+
+def _compile(fn: Callable, entry_point: bool = False) -> Callable:
+    """Wrap `fn` with torch.compile(), if FAST_RNNT_COMPILE is set.
+
+    With FAST_RNNT_COMPILE=1 only the private helpers doing the heavy lifting
+    are compiled, with dynamic shapes.  With FAST_RNNT_COMPILE=static the
+    public get_rnnt_logprobs* functions (i.e. entry_point == True) are compiled
+    too, and everything is compiled with static shapes and
+    mode="max-autotune-no-cudagraphs", which gives the fastest kernels, but
+    recompiles for every new shape of the inputs.  So only use it if your
+    batches are bucketed, i.e. (B, T, S, C, s_range) only take a few distinct
+    values; once torch._dynamo.config.cache_size_limit shapes have been seen,
+    the function runs in eager mode for new shapes.
+
+    If dynamo or Inductor fails while compiling the forward pass (e.g. because
+    no working C++/Triton toolchain is installed), we print a warning and use
+    the eager `fn` from then on; any other error (e.g. a failed assert on the
+    inputs, or running out of memory) is raised as usual.  The backward pass
+    is compiled on its first call, from within autograd, so failures there
+    are not caught.
+    """
+    if not _use_torch_compile:
+        return fn
+    if _use_static_compile:
+        compiled = torch.compile(
+            fn, dynamic=False, mode="max-autotune-no-cudagraphs"
+        )
+    elif entry_point:
+        return fn
+    else:
+        compiled = torch.compile(fn, dynamic=True)
+
+    failed = False
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal failed
+        # If we are being traced as part of a compiled caller, let dynamo
+        # inline the eager function.
+        if failed or torch._dynamo.is_compiling():
+            return fn(*args, **kwargs)
+        try:
+            return compiled(*args, **kwargs)
+        except torch._dynamo.exc.TorchDynamoException as e:
+            failed = True
+            print(
+                f"Warning: torch.compile() of {fn.__name__} failed, "
+                f"falling back to eager mode: {e}"
+            )
+            return fn(*args, **kwargs)
+
+    return wrapper
+
 
 def validate_st_lengths(
     S: int,
@@ -63,6 +134,174 @@ def fix_for_boundary(px: Tensor, boundary: Optional[Tensor] = None) -> Tensor:
     return px.scatter_(dim=2, index=boundary, value=float("-inf"))
 
 
+def _append_inf_frame(px: Tensor) -> Tensor:
+    """
+    Append a frame of -inf's to `px`, i.e. the "one-past-the-last" frame on
+    which (if rnnt_type == "regular") we cannot emit any symbols.
+
+    We write `px` into a preallocated -inf buffer instead of using torch.cat(),
+    which would allocate the -inf frame separately and then copy both inputs
+    (and can't be fused with the producer of `px` under torch.compile()).
+
+    Args:
+      px:
+        A Tensor of shape [B][S][T].
+    Returns:
+      A Tensor of shape [B][S][T+1], with [:,:,:T] equal to `px` and [:,:,T]
+      equal to -inf.
+    """
+    (B, S, T) = px.shape
+    ans = torch.full(
+        (B, S, T + 1), float("-inf"), device=px.device, dtype=px.dtype
+    )
+    ans[:, :, :T] = px
+    return ans
+
+
+def _logprobs_dtype(dtype: torch.dtype) -> torch.dtype:
+    """Return the dtype of the px and py computed from logits of `dtype`,
+    mutual_information_recursion() only supports float32 and float64, so
+    float16/bfloat16 logits give float32 px and py.
+    """
+    if dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return dtype
+
+
+class _HalfLogsumexpFunction(torch.autograd.Function):
+    """Computes ``torch.logsumexp(x.float(), dim=-1)`` for a float16/bfloat16
+    `x`, without materializing a float32 copy of `x`.
+
+    The float32 exp-sum is accumulated over chunks of `chunk_size` columns,
+    so the float32 temporaries only have `chunk_size` columns, and only the
+    half precision `x` and the float32 result are saved for backward, which
+    computes the gradient chunk by chunk in the same way.  (Converting `x` up
+    front would keep the float32 copy alive until the backward pass, as
+    torch.logsumexp() saves its input.)
+    """
+
+    @staticmethod
+    def forward(ctx, x: Tensor, chunk_size: int) -> Tensor:
+        C = x.shape[-1]
+        x_max, _ = torch.max(x, dim=-1, keepdim=True)
+        x_max = x_max.float()
+        # as in torch.logsumexp(), rows whose max is +-inf are not shifted, so
+        # that all -inf rows give -inf instead of nan.
+        x_max.masked_fill_(torch.isinf(x_max), 0.0)
+
+        sum_exp = torch.zeros(x_max.shape, device=x.device, dtype=x_max.dtype)
+        for c in range(0, C, chunk_size):
+            x_chunk = x[..., c : c + chunk_size].float()
+            sum_exp += x_chunk.sub_(x_max).exp_().sum(dim=-1, keepdim=True)
+        ans = sum_exp.log_().add_(x_max).squeeze(-1)
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(x, ans)
+        return ans
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, ans_grad: Tensor) -> Tuple[Tensor, None]:
+        x, ans = ctx.saved_tensors
+        C = x.shape[-1]
+        ans = ans.unsqueeze(-1)
+        ans_grad = ans_grad.unsqueeze(-1)
+        x_grad = torch.empty_like(x)
+        for c in range(0, C, ctx.chunk_size):
+            x_chunk = x[..., c : c + ctx.chunk_size].float()
+            x_grad[..., c : c + ctx.chunk_size] = (
+                x_chunk.sub_(ans).exp_().mul_(ans_grad)
+            )
+        return x_grad, None
+
+
+def _logsumexp(x: Tensor, chunk_size: int = 64) -> Tensor:
+    """Like ``torch.logsumexp(x, dim=-1)``, but for float16/bfloat16 `x`, it is
+    computed (and the result returned) in float32.
+
+    Under torch.compile() the conversion is fused into the reduction, so `x` is
+    read in its own dtype and no float32 copy of it is materialized; in eager
+    mode we use _HalfLogsumexpFunction, which works on `chunk_size` columns of
+    `x` at a time to get the same effect.
+    """
+    if x.dtype not in (torch.float16, torch.bfloat16):
+        return torch.logsumexp(x, dim=-1)
+    if _use_torch_compile and torch._dynamo.is_compiling():
+        return torch.logsumexp(x.float(), dim=-1)
+    return _HalfLogsumexpFunction.apply(x, chunk_size)
+
+
+class _SimpleNormalizersFunction(torch.autograd.Function):
+    """Computes the normalizers of the simple joiner (i.e. the joiner is just
+    addition), i.e. ``normalizers[b][s][t] = log(sum_c exp(lm[b][s][c] +
+    am[b][t][c]))``, of shape [B][S+1][T].
+
+    We don't rely on autograd here, as it would keep the exponentiated lm and
+    am (and the [B][S+1][T] sum of their products) alive until the backward
+    pass.  Instead we only save the inputs and the output, and recompute the
+    exponentiated lm and am in backward, reusing their memory for the
+    gradients.
+
+    Caution: As the backward overwrites tensors in place, it is not itself
+    differentiable, i.e. double backward (create_graph=True) through
+    get_rnnt_logprobs() is not supported.
+    """
+
+    @staticmethod
+    def forward(ctx, lm: Tensor, am: Tensor) -> Tensor:
+        # subtracting am_max and lm_max is to ensure the probs are in a
+        # good range to do exp() without causing underflow or overflow.
+        am_max, _ = torch.max(am, dim=2, keepdim=True)  # [B][T][1]
+        lm_max, _ = torch.max(lm, dim=2, keepdim=True)  # [B][S+1][1]
+        am_probs = (am - am_max).exp()
+        lm_probs = (lm - lm_max).exp()
+        # normalizers: [B][S+1][T]
+        normalizers = (
+            torch.matmul(lm_probs, am_probs.transpose(1, 2))
+            + torch.finfo(am_probs.dtype).tiny
+        ).log()
+
+        # add lm_max and am_max to normalizers, to make it as if we had not
+        # subtracted am_max and lm_max above.
+        normalizers += lm_max + am_max.transpose(1, 2)  # [B][S+1][T]
+        ctx.save_for_backward(lm, am, normalizers)
+        return normalizers
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(
+        ctx, normalizers_grad: Tensor
+    ) -> Tuple[Optional[Tensor], Optional[Tensor]]:
+        lm, am, normalizers = ctx.saved_tensors
+        lm_needs_grad, am_needs_grad = ctx.needs_input_grad
+
+        am_max, _ = torch.max(am, dim=2, keepdim=True)  # am_max: [B][T][1]
+        lm_max, _ = torch.max(lm, dim=2, keepdim=True)  # lm_max: [B][S+1][1]
+        am_probs = (am - am_max).exp()  # [B][T][C]
+        lm_probs = (lm - lm_max).exp()  # [B][S+1][C]
+
+        # d normalizers[b][s][t] / d lm[b][s][c]
+        #   = exp(lm[b][s][c] + am[b][t][c] - normalizers[b][s][t])
+        #   = lm_probs[b][s][c] * am_probs[b][t][c] / probs_sum[b][s][t]
+        # where probs_sum is the matmul of lm_probs and am_probs^T, as in
+        # forward; likewise for am.
+        probs_sum = (
+            (normalizers - lm_max - am_max.transpose(1, 2))
+            .exp_()
+            .add_(torch.finfo(am_probs.dtype).tiny)
+        )  # [B][S+1][T]
+        scaled_grad = normalizers_grad / probs_sum  # [B][S+1][T]
+
+        lm_grad, am_grad = None, None
+        if am_needs_grad:
+            # [B][T][C], computed before lm_probs is overwritten below.
+            am_grad = torch.matmul(scaled_grad.transpose(1, 2), lm_probs)
+        if lm_needs_grad:
+            lm_grad = lm_probs.mul_(torch.matmul(scaled_grad, am_probs))
+        if am_needs_grad:
+            am_grad = am_probs.mul_(am_grad)
+        return lm_grad, am_grad
+
+
 def get_rnnt_logprobs(
     lm: Tensor,
     am: Tensor,
@@ -169,50 +408,28 @@ def get_rnnt_logprobs(
     validate_st_lengths(S, T, rnnt_type == "regular", boundary)
     assert rnnt_type in ["regular", "modified", "constrained"], rnnt_type
 
-    # subtracting am_max and lm_max is to ensure the probs are in a good range
-    # to do exp() without causing underflow or overflow.
-    am_max, _ = torch.max(am, dim=2, keepdim=True)  # am_max: [B][T][1]
-    lm_max, _ = torch.max(lm, dim=2, keepdim=True)  # lm_max: [B][S+1][1]
-    am_probs = (am - am_max).exp()
-    lm_probs = (lm - lm_max).exp()
     # normalizers: [B][S+1][T]
-    normalizers = (
-        torch.matmul(lm_probs, am_probs.transpose(1, 2))
-        + torch.finfo(am_probs.dtype).tiny
-    ).log()
-
-    # add lm_max and am_max to normalizers, to make it as if we had not
-    # subtracted am_max and lm_max above.
-    normalizers = normalizers + lm_max + am_max.transpose(1, 2)  # [B][S+1][T]
+    normalizers = _SimpleNormalizersFunction.apply(lm, am)
 
     # px is the probs of the actual symbols..
+    # We gather along the contiguous C axis of `am` (the index is a stride-0
+    # view of `symbols`), which gives px_am in (B, T, S) layout; the transpose
+    # to (B, S, T) is folded into the in-place add below, whose output is the
+    # contiguous px_lm - normalizers, so px is contiguous for all rnnt_types.
     px_am = torch.gather(
-        am.transpose(1, 2),  # (B, C, T)
-        dim=1,
-        index=symbols.unsqueeze(2).expand(B, S, T),
-    )  #  (B, S, T)
-
-    if rnnt_type == "regular":
-        px_am = torch.cat(
-            (
-                px_am,
-                torch.full(
-                    (B, S, 1),
-                    float("-inf"),
-                    device=px_am.device,
-                    dtype=px_am.dtype,
-                ),
-            ),
-            dim=2,
-        )  # now: [B][S][T+1], index [:,:,T] has -inf..
+        am, dim=2, index=symbols.unsqueeze(1).expand(B, T, S)
+    )  # (B, T, S)
+    px_am = px_am.transpose(1, 2)  # (B, S, T), non-contiguous view
 
     px_lm = torch.gather(
         lm[:, :S], dim=2, index=symbols.unsqueeze(-1)
     )  # [B][S][1]
 
-    px = px_am + px_lm  # [B][S][T+1], last slice with indexes out of
-    # boundary is  -inf
-    px[:, :, :T] -= normalizers[:, :S, :]  # px: [B][S][T+1]
+    px = px_lm - normalizers[:, :S, :]  # [B][S][T]
+    px += px_am
+
+    if rnnt_type == "regular":
+        px = _append_inf_frame(px)  # now: [B][S][T+1], index [:,:,T] has -inf
 
     # py is the probs of termination symbols, of shape [B][S+1][T]
     py_am = am[:, :, termination_symbol].unsqueeze(1)  # [B][1][T]
@@ -227,6 +444,9 @@ def get_rnnt_logprobs(
     return (px, py)
 
 
+get_rnnt_logprobs = _compile(get_rnnt_logprobs, entry_point=True)
+
+
 def rnnt_loss_simple(
     lm: Tensor,
     am: Tensor,
@@ -415,30 +635,57 @@ def get_rnnt_logprobs_joint(
     validate_st_lengths(S, T, rnnt_type == "regular", boundary)
     assert rnnt_type in ["regular", "modified", "constrained"], rnnt_type
 
-    normalizers = torch.logsumexp(logits, dim=3)
+    return _get_rnnt_logprobs_joint(
+        logits=logits,
+        symbols=symbols,
+        termination_symbol=termination_symbol,
+        boundary=boundary,
+        rnnt_type=rnnt_type,
+    )
+
+
+get_rnnt_logprobs_joint = _compile(get_rnnt_logprobs_joint, entry_point=True)
+
+
+def _get_rnnt_logprobs_joint(
+    logits: Tensor,
+    symbols: Tensor,
+    termination_symbol: int,
+    boundary: Optional[Tensor],
+    rnnt_type: str,
+) -> Tuple[Tensor, Tensor]:
+    """The implementation of :func:`get_rnnt_logprobs_joint`, see its docs for
+    the meaning of the arguments, which are assumed to be validated already.
+
+    `logits` is the largest tensor of the unpruned loss, and this function
+    reads it several times (logsumexp and two gathers), so it is wrapped with
+    torch.compile() (if FAST_RNNT_COMPILE is set), which fuses them into a
+    kernel that reads each row of C once.
+    """
+    (B, T, S1, C) = logits.shape
+    S = S1 - 1
+
+    # float32 if logits are float16/bfloat16
+    normalizers = _logsumexp(logits)
     normalizers = normalizers.permute((0, 2, 1))
 
+    # The index is a stride-0 view of `symbols`, so this only reads the
+    # B * T * S selected elements of `logits`.  Note: don't flatten
+    # `logits[:, :, :S]` to (B, T * S, C) here, as it is not contiguous and
+    # the reshape would copy the whole tensor.
     px = torch.gather(
         logits, dim=3, index=symbols.reshape(B, 1, S, 1).expand(B, T, S, 1)
     ).squeeze(-1)
-    px = px.permute((0, 2, 1))
+    px = px.permute((0, 2, 1)).to(normalizers.dtype)
+    px -= normalizers[:, :S, :]
 
     if rnnt_type == "regular":
-        px = torch.cat(
-            (
-                px,
-                torch.full(
-                    (B, S, 1), float("-inf"), device=px.device, dtype=px.dtype
-                ),
-            ),
-            dim=2,
-        )  # now: [B][S][T+1], index [:,:,T] has -inf..
-
-    px[:, :, :T] -= normalizers[:, :S, :]
-
-    py = (
-        logits[:, :, :, termination_symbol].permute((0, 2, 1)).clone()
-    )  # [B][S+1][T]
+        px = _append_inf_frame(px)  # now: [B][S][T+1], index [:,:,T] has -inf
+
+    # [B][S+1][T], copied into a contiguous buffer (the layout
+    # mutual_information_recursion() wants) with a single strided copy.
+    py = torch.empty((B, S1, T), device=logits.device, dtype=normalizers.dtype)
+    py.copy_(logits[:, :, :, termination_symbol].transpose(1, 2))
     py -= normalizers
 
     if rnnt_type == "regular":
@@ -449,6 +696,91 @@ def get_rnnt_logprobs_joint(
     return (px, py)
 
 
+# get_rnnt_logprobs_joint_samplewise() calls the eager version: the per-sample
+# slices of `logits` have a different storage offset (and usually shape) for
+# every sample, each of which would be a new guard for the compiled version.
+_get_rnnt_logprobs_joint_eager = _get_rnnt_logprobs_joint
+_get_rnnt_logprobs_joint = _compile(_get_rnnt_logprobs_joint)
+
+
+def get_rnnt_logprobs_joint_samplewise(
+    logits: Tensor,
+    symbols: Tensor,
+    termination_symbol: int,
+    boundary: Tensor,
+    rnnt_type: str = "regular",
+) -> Tuple[Tensor, Tensor]:
+    """A version of :func:`get_rnnt_logprobs_joint` that processes the batch
+    one sequence at a time, only touching the un-padded part
+    ``logits[b, :T_b, :S_b + 1]`` of each sequence, where
+    ``S_b = boundary[b, 2]`` and ``T_b = boundary[b, 3]``.
+
+    This is useful when the lengths within a batch vary a lot, in which case
+    most of `logits` is padding; the time spent in the forward pass (and the
+    memory used by its intermediate results) then scales with the real lengths
+    instead of with ``B * T * (S + 1)``.  The backward pass still writes one
+    gradient of the full size of `logits` (zero in the padding), as
+    ``logits.unbind(0)`` stacks the per-sequence gradients once.
+
+    Args:
+      logits:
+        The output of joiner network, with shape (B, T, S + 1, C),
+        i.e. batch, time_seq_len, symbol_seq_len+1, num_classes
+      symbols:
+        A LongTensor of shape [B][S], containing the symbols at each position
+        of the sequence.
+      termination_symbol:
+        The identity of the termination symbol, must be in {0..C-1}
+      boundary:
+        a LongTensor of shape [B, 4] with elements interpreted as
+        [begin_symbol, begin_frame, end_symbol, end_frame]. Unlike in
+        :func:`get_rnnt_logprobs_joint` it is required here.
+      rnnt_type:
+        Specifies the type of rnnt paths: `regular`, `modified` or
+        `constrained`, see docs in :func:`get_rnnt_logprobs_joint`.
+    Returns:
+      (px, py), with the same shapes and meaning as the ones returned by
+      :func:`get_rnnt_logprobs_joint`; the positions outside of
+      ``[:S_b, :T_b + 1]`` (for px, ``[:S_b, :T_b]`` if rnnt_type is not
+      regular) and ``[:S_b + 1, :T_b]`` (for py) are filled with -inf.
+    """
+    assert logits.ndim == 4, logits.ndim
+    (B, T, S1, C) = logits.shape
+    S = S1 - 1
+    assert symbols.shape == (B, S), symbols.shape
+    assert boundary is not None
+    assert boundary.shape == (B, 4), boundary.shape
+
+    validate_st_lengths(S, T, rnnt_type == "regular", boundary)
+    assert rnnt_type in ["regular", "modified", "constrained"], rnnt_type
+
+    T0 = T + 1 if rnnt_type == "regular" else T
+    dtype = _logprobs_dtype(logits.dtype)
+    px = torch.full(
+        (B, S, T0), float("-inf"), device=logits.device, dtype=dtype
+    )
+    py = torch.full(
+        (B, S + 1, T), float("-inf"), device=logits.device, dtype=dtype
+    )
+    # We split `logits` with a single unbind(), whose backward stacks the
+    # per-sequence gradients once; slicing logits[b : b + 1] instead would make
+    # every sequence's backward allocate (and sum) a full-size gradient.
+    for b, (logits_b, (_, _, S_b, T_b)) in enumerate(
+        zip(logits.unbind(0), boundary.tolist())
+    ):
+        px_b, py_b = _get_rnnt_logprobs_joint_eager(
+            logits=logits_b[:T_b, : S_b + 1].unsqueeze(0),
+            symbols=symbols[b : b + 1, :S_b],
+            termination_symbol=termination_symbol,
+            boundary=None,
+            rnnt_type=rnnt_type,
+        )
+        px[b, :S_b, : px_b.shape[2]] = px_b[0]
+        py[b, : S_b + 1, :T_b] = py_b[0]
+
+    return (px, py)
+
+
 def rnnt_loss(
     logits: Tensor,
     symbols: Tensor,
@@ -547,6 +879,18 @@ def rnnt_loss(
     return (loss, scores_and_grads[1]) if return_grad else loss
 
 
+@functools.lru_cache(maxsize=64)
+def _arange(n: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+    """Return ``torch.arange(n, device=device, dtype=dtype)``, cached so that we
+    don't allocate (and fill) a new tensor on every call in the training loop.
+
+    Caution:
+      The returned tensor is shared between callers, it must not be modified
+      in-place.
+    """
+    return torch.arange(n, device=device, dtype=dtype)
+
+
 def _monotonic_lower_bound(x: Tensor) -> Tensor:
     """Compute a monotonically increasing lower bound of the tensor `x` on the
     last dimension. The basic idea is: we traverse the tensor in reverse order,
@@ -617,18 +961,13 @@ def _adjust_pruning_lower_bound(s_begin: Tensor, s_range: int) -> Tensor:
     # s_begin (B, T)
     (B, T) = s_begin.shape
     s_begin = _monotonic_lower_bound(s_begin)
-    # do the magic transformation
-    s_begin = -(
-        s_begin - (s_range - 1) * torch.arange(0, T, device=s_begin.device)
-    )
-    # make the transformed tensor to be non-decreasing
-    s_begin = _monotonic_lower_bound(s_begin)
-    # make start symbol to be zero.
-    s_begin = torch.clamp(s_begin, min=0)
+    # the magic transformation is `x -> offset - x`, which is its own inverse.
+    offset = (s_range - 1) * _arange(T, s_begin.device, s_begin.dtype)
+    # do the magic transformation, make the transformed tensor to be
+    # non-decreasing, and make start symbol to be zero.
+    s_begin = _monotonic_lower_bound(offset - s_begin).clamp_(min=0)
     # do the magic transformation again to recover s_begin
-    s_begin = -(
-        s_begin - (s_range - 1) * torch.arange(0, T, device=s_begin.device)
-    )
+    s_begin = offset - s_begin
     return s_begin
 
 
@@ -731,14 +1070,11 @@ def get_rnnt_prune_ranges(
     )
 
     # (B, S1 - s_range + 1, T)
-    blk_sum_grad = torch.sum(blk_grad, axis=2)
+    final_grad = torch.sum(blk_grad, axis=2)
 
-    px_pad = torch.zeros((B, 1, T1), dtype=px_grad.dtype, device=px_grad.device)
-    # (B, S1, T)
-    px_grad_pad = torch.cat((px_pad, px_grad), dim=1)
-
-    # (B, S1 - s_range + 1, T)
-    final_grad = blk_sum_grad - px_grad_pad[:, : S1 - s_range + 1, :T]
+    # Subtract px_grad shifted by one symbol, i.e. as if it was padded with a
+    # row of zeros at s == 0, without materializing the padded tensor.
+    final_grad[:, 1:, :] -= px_grad[:, : S1 - s_range, :T]
 
     # (B, T)
     s_begin = torch.argmax(final_grad, axis=1)
@@ -753,7 +1089,7 @@ def get_rnnt_prune_ranges(
     # [[True, True, False, False, False, False],
     #  [True, True, True,  True,  False, False],
     #  [True, True, True,  True,  True,  False]]
-    mask = torch.arange(0, T, device=px_grad.device).reshape(1, T).expand(B, T)
+    mask = _arange(T, px_grad.device, s_begin.dtype).reshape(1, T).expand(B, T)
     mask = mask < boundary[:, 3].reshape(B, 1) - 1
 
     s_begin_padding = boundary[:, 2].reshape(B, 1) - s_range + 1
@@ -770,8 +1106,9 @@ def get_rnnt_prune_ranges(
     # frame.
     s_begin = _adjust_pruning_lower_bound(s_begin, 2 if T1 == T else s_range)
 
-    ranges = s_begin.reshape((B, T, 1)).expand((B, T, s_range)) + torch.arange(
-        s_range, device=px_grad.device
+    # (B, T, s_range)
+    ranges = s_begin.unsqueeze(-1) + _arange(
+        s_range, px_grad.device, s_begin.dtype
     )
 
     return ranges
@@ -795,6 +1132,13 @@ def do_rnnt_pruning(
 
     Returns:
       Return the pruned am and lm with shape (B, T, s_range, C)
+
+    Note:
+      The returned am is an expanded view of the input `am` (i.e. it has a
+      stride of 0 on the s_range axis), no memory is allocated for it. Don't
+      call ``.contiguous()`` or ``.clone()`` on it, just feed it to the joiner
+      together with the pruned lm, e.g. ``joiner(am_pruned + lm_pruned)``, so
+      that the broadcast is done inside the joiner's first op.
     """
     # am (B, T, C)
     # lm (B, S + 1, C)
@@ -809,7 +1153,9 @@ def do_rnnt_pruning(
     # (B, T, s_range, C)
     am_pruning = am.unsqueeze(2).expand((B, T, s_range, C))
 
-    # (B, T, s_range, C)
+    # (B, T, s_range, C), we gather the kept rows of lm along the S axis with
+    # an expanded (stride-0 on C) index, so lm is never expanded to
+    # (B, T, S + 1, C) and only the B * T * s_range kept rows are copied.
     lm_pruning = torch.gather(
         lm,
         dim=1,
@@ -818,41 +1164,6 @@ def do_rnnt_pruning(
     return am_pruning, lm_pruning
 
 
-def _roll_by_shifts(src: Tensor, shifts: torch.LongTensor):
-    """Roll tensor with different shifts for each row.
-
-    Note:
-      We assume the src is a 3 dimensions tensor and roll the last dimension.
-
-    Example:
-
-      >>> src = torch.arange(15).reshape((1,3,5))
-      >>> src
-      tensor([[[ 0,  1,  2,  3,  4],
-               [ 5,  6,  7,  8,  9],
-               [10, 11, 12, 13, 14]]])
-      >>> shift = torch.tensor([[1, 2, 3]])
-      >>> shift
-      tensor([[1, 2, 3]])
-      >>> _roll_by_shifts(src, shift)
-      tensor([[[ 4,  0,  1,  2,  3],
-               [ 8,  9,  5,  6,  7],
-               [12, 13, 14, 10, 11]]])
-    """
-    assert src.dim() == 3, src.dim()
-    (B, T, S) = src.shape
-    assert shifts.shape == (B, T), shifts.shape
-
-    index = (
-        torch.arange(S, device=src.device)
-        .view((1, S))
-        .repeat((T, 1))
-        .repeat((B, 1, 1))
-    )
-    index = (index - shifts.reshape(B, T, 1)) % S
-    return torch.gather(src, 2, index)
-
-
 def get_rnnt_logprobs_pruned(
     logits: Tensor,
     symbols: Tensor,
@@ -937,82 +1248,82 @@ def get_rnnt_logprobs_pruned(
     validate_st_lengths(S, T, rnnt_type == "regular", boundary)
     assert rnnt_type in ["regular", "modified", "constrained"], rnnt_type
 
-    normalizers = torch.logsumexp(logits, dim=3)
-
-    symbols_with_terminal = torch.cat(
-        (
-            symbols,
-            torch.tensor(
-                [termination_symbol] * B,
-                dtype=torch.int64,
-                device=symbols.device,
-            ).reshape((B, 1)),
-        ),
-        dim=1,
+    return _get_rnnt_logprobs_pruned(
+        logits=logits,
+        symbols=symbols,
+        ranges=ranges,
+        termination_symbol=termination_symbol,
+        boundary=boundary,
+        rnnt_type=rnnt_type,
     )
 
-    # (B, T, s_range)
+
+get_rnnt_logprobs_pruned = _compile(get_rnnt_logprobs_pruned, entry_point=True)
+
+
+def _get_rnnt_logprobs_pruned(
+    logits: Tensor,
+    symbols: Tensor,
+    ranges: Tensor,
+    termination_symbol: int,
+    boundary: Optional[Tensor],
+    rnnt_type: str,
+) -> Tuple[Tensor, Tensor]:
+    """The implementation of :func:`get_rnnt_logprobs_pruned`, see its docs for
+    the meaning of the arguments, which are assumed to be validated already.
+
+    It is a chain of small gather / pointwise ops, so it is wrapped with
+    torch.compile() (if FAST_RNNT_COMPILE is set) to fuse them into fewer
+    kernels.
+    """
+    (B, T, s_range, C) = logits.shape
+    (B, S) = symbols.shape
+
+    # float32 if logits are float16/bfloat16
+    normalizers = _logsumexp(logits)
+
+    # (B, T, s_range), position S (i.e. after the last symbol) is the
+    # termination symbol, so we gather with that index clamped and fill it in
+    # afterwards, rather than gathering from `symbols` with the termination
+    # symbol appended.
     pruned_symbols = torch.gather(
-        symbols_with_terminal.unsqueeze(1).expand((B, T, S + 1)),
+        symbols.unsqueeze(1).expand((B, T, S)),
         dim=2,
-        index=ranges,
+        index=ranges.clamp(max=S - 1),
     )
+    pruned_symbols.masked_fill_(ranges == S, termination_symbol)
 
     # (B, T, s_range)
     px = torch.gather(
         logits, dim=3, index=pruned_symbols.reshape(B, T, s_range, 1)
     ).squeeze(-1)
-    px = px - normalizers
-
-    # (B, T, S) with index larger than s_range in dim 2 fill with -inf
-    px = torch.cat(
-        (
-            px,
-            torch.full(
-                (B, T, S + 1 - s_range),
-                float("-inf"),
-                device=px.device,
-                dtype=px.dtype,
-            ),
-        ),
-        dim=2,
-    )
 
-    # (B, T, S) with index out of s_range in dim 2 fill with -inf
-    px = _roll_by_shifts(px, ranges[:, :, 0])[:, :, :S]
+    # (B, T, S + 1), px[b, t, ranges[b, t, i]] is the i-th kept symbol on
+    # frame t, the positions out of the pruning range are filled with -inf.
+    px = torch.full(
+        (B, T, S + 1),
+        float("-inf"),
+        device=px.device,
+        dtype=normalizers.dtype,
+    ).scatter_(dim=2, index=ranges, src=px - normalizers)
 
-    px = px.permute((0, 2, 1))
+    # (B, S, T)
+    px = px[:, :, :S].permute((0, 2, 1))
 
     if rnnt_type == "regular":
-        px = torch.cat(
-            (
-                px,
-                torch.full(
-                    (B, S, 1), float("-inf"), device=px.device, dtype=px.dtype
-                ),
-            ),
-            dim=2,
-        )  # now: [B][S][T+1], index [:,:,T] has -inf..
-
-    py = logits[:, :, :, termination_symbol].clone()  # (B, T, s_range)
-    py = py - normalizers
-
-    # (B, T, S + 1) with index larger than s_range in dim 2 filled with -inf
-    py = torch.cat(
-        (
-            py,
-            torch.full(
-                (B, T, S + 1 - s_range),
-                float("-inf"),
-                device=py.device,
-                dtype=py.dtype,
-            ),
-        ),
+        px = _append_inf_frame(px)  # now: [B][S][T+1], index [:,:,T] has -inf
+
+    # (B, T, S + 1) with index out of s_range in dim 2 filled with -inf
+    py = torch.full(
+        (B, T, S + 1),
+        float("-inf"),
+        device=logits.device,
+        dtype=normalizers.dtype,
+    ).scatter_(
         dim=2,
+        index=ranges,
+        src=logits[:, :, :, termination_symbol] - normalizers,
     )
-
-    # (B, T, S + 1) with index out of s_range in dim 2 fill with -inf
-    py = _roll_by_shifts(py, ranges[:, :, 0])
     # (B, S + 1, T)
     py = py.permute((0, 2, 1))
 
@@ -1024,6 +1335,9 @@ def get_rnnt_logprobs_pruned(
     return (px, py)
 
 
+_get_rnnt_logprobs_pruned = _compile(_get_rnnt_logprobs_pruned)
+
+
 def rnnt_loss_pruned(
     logits: Tensor,
     symbols: Tensor,
@@ -1297,24 +1611,17 @@ def get_rnnt_logprobs_smoothed(
 
     # px is the probs of the actual symbols (not yet normalized)..
     px_am = torch.gather(
-        am.transpose(1, 2),  # (B, C, T)
-        dim=1,
-        index=symbols.unsqueeze(2).expand(B, S, T),
-    )  #  (B, S, T)
+        am, dim=2, index=symbols.unsqueeze(1).expand(B, T, S)
+    )  # (B, T, S)
+    px_am = px_am.transpose(1, 2)  # (B, S, T), non-contiguous view
 
     if rnnt_type == "regular":
-        px_am = torch.cat(
-            (
-                px_am,
-                torch.full(
-                    (B, S, 1),
-                    float("-inf"),
-                    device=px_am.device,
-                    dtype=px_am.dtype,
-                ),
-            ),
-            dim=2,
-        )  # now: [B][S][T+1], index [:,:,T] has -inf..
+        # now: [B][S][T+1], index [:,:,T] has -inf..
+        px_am = _append_inf_frame(px_am)
+    else:
+        # px_am is used in several sums below, copy it once so that they (and
+        # the returned px) have the contiguous [B][S][T] layout.
+        px_am = px_am.contiguous()
 
     px_lm = torch.gather(
         lm[:, :S], dim=2, index=symbols.unsqueeze(-1)
@@ -1369,6 +1676,11 @@ def get_rnnt_logprobs_smoothed(
     return (px_interp, py_interp)
 
 
+get_rnnt_logprobs_smoothed = _compile(
+    get_rnnt_logprobs_smoothed, entry_point=True
+)
+
+
 def rnnt_loss_smoothed(
     lm: Tensor,
     am: Tensor,
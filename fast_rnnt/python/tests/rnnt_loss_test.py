@@ -21,9 +21,13 @@
 #
 #  ctest --verbose -R rnnt_loss_test_py
 
+import importlib
+import os
 import unittest
+import unittest.mock
 
 import fast_rnnt
+import fast_rnnt.rnnt_loss
 import random
 import torch
 
@@ -224,11 +228,10 @@ class TestRnntLoss(unittest.TestCase):
                     boundary=boundary,
                     rnnt_type=rnnt_type,
                 )
-                assert (
-                    px.shape == (B, S, T)
-                    if rnnt_type != "regular"
-                    else (B, S, T + 1)
+                assert px.shape == (
+                    (B, S, T) if rnnt_type != "regular" else (B, S, T + 1)
                 )
+                assert px.is_contiguous()
                 assert py.shape == (B, S + 1, T)
                 assert symbols.shape == (B, S)
                 m = fast_rnnt.mutual_information_recursion(
@@ -381,6 +384,263 @@ class TestRnntLoss(unittest.TestCase):
                     fast_grad, torch_grad, atol=1e-2, rtol=1e-2
                 )
 
+    def test_rnnt_loss_simple_gradient(self):
+        B = 5
+        S = 20
+        T = 300
+        C = 100
+        frames = torch.randint(S, T, (B,))
+        seq_length = torch.randint(3, S - 1, (B,))
+        T = torch.max(frames)
+        S = torch.max(seq_length)
+
+        am_ = torch.randn((B, T, C), dtype=torch.float32)
+        lm_ = torch.randn((B, S + 1, C), dtype=torch.float32)
+        symbols_ = torch.randint(0, C - 1, (B, S))
+        termination_symbol = C - 1
+
+        boundary_ = torch.zeros((B, 4), dtype=torch.int64)
+        boundary_[:, 2] = seq_length
+        boundary_[:, 3] = frames
+
+        for rnnt_type in ["regular", "modified", "constrained"]:
+            for device in self.devices:
+                # lm: [B][S+1][C]
+                lm = lm_.to(device).detach().requires_grad_()
+                # am: [B][T][C]
+                am = am_.to(device).detach().requires_grad_()
+                symbols = symbols_.to(device)
+                boundary = boundary_.to(device)
+
+                simple_loss = fast_rnnt.rnnt_loss_simple(
+                    lm=lm,
+                    am=am,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                )
+                simple_lm_grad, simple_am_grad = torch.autograd.grad(
+                    simple_loss, (lm, am)
+                )
+
+                # the gradients of the full rnnt loss wrt lm and am, which
+                # don't go through the simple loss' normalizers.
+                logits = am.unsqueeze(2) + lm.unsqueeze(1)
+                loss = fast_rnnt.rnnt_loss(
+                    logits=logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                )
+                lm_grad, am_grad = torch.autograd.grad(loss, (lm, am))
+
+                assert torch.allclose(simple_loss, loss, atol=1e-3, rtol=1e-3)
+                assert torch.allclose(
+                    simple_lm_grad, lm_grad, atol=1e-3, rtol=1e-3
+                )
+                assert torch.allclose(
+                    simple_am_grad, am_grad, atol=1e-3, rtol=1e-3
+                )
+
+    def test_rnnt_logprobs_joint_samplewise(self):
+        B = 5
+        S = 20
+        T = 100
+        C = 50
+        frames = torch.randint(S, T, (B,))
+        seq_length = torch.randint(3, S - 1, (B,))
+        T = torch.max(frames)
+        S = torch.max(seq_length)
+
+        logits_ = torch.randn((B, T, S + 1, C), dtype=torch.float32)
+        symbols_ = torch.randint(0, C - 1, (B, S))
+        termination_symbol = C - 1
+
+        boundary_ = torch.zeros((B, 4), dtype=torch.int64)
+        boundary_[:, 2] = seq_length
+        boundary_[:, 3] = frames
+
+        for rnnt_type in ["regular", "modified", "constrained"]:
+            for device in self.devices:
+                logits = logits_.to(device).detach().requires_grad_()
+                symbols = symbols_.to(device)
+                boundary = boundary_.to(device)
+
+                px, py = fast_rnnt.get_rnnt_logprobs_joint(
+                    logits=logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                )
+                m = fast_rnnt.mutual_information_recursion(
+                    px=px, py=py, boundary=boundary
+                )
+                (grad,) = torch.autograd.grad(m.sum(), logits)
+
+                px, py = fast_rnnt.get_rnnt_logprobs_joint_samplewise(
+                    logits=logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                )
+                assert px.shape == (
+                    (B, S, T) if rnnt_type != "regular" else (B, S, T + 1)
+                )
+                assert py.shape == (B, S + 1, T)
+                samplewise_m = fast_rnnt.mutual_information_recursion(
+                    px=px, py=py, boundary=boundary
+                )
+                (samplewise_grad,) = torch.autograd.grad(
+                    samplewise_m.sum(), logits
+                )
+
+                assert torch.allclose(m, samplewise_m, atol=1e-3, rtol=1e-3)
+                assert torch.allclose(
+                    grad, samplewise_grad, atol=1e-3, rtol=1e-3
+                )
+
+    def test_rnnt_loss_half_logits(self):
+        B = 5
+        S = 20
+        T = 100
+        C = 50
+        frames = torch.randint(S, T, (B,))
+        seq_length = torch.randint(3, S - 1, (B,))
+        T = torch.max(frames)
+        S = torch.max(seq_length)
+
+        # round the logits to bfloat16 first, so that the float32 reference
+        # sees exactly the same values.
+        logits_ = torch.randn((B, T, S + 1, C)).to(torch.bfloat16)
+        am_ = torch.randn((B, T, C))
+        lm_ = torch.randn((B, S + 1, C))
+        symbols_ = torch.randint(0, C - 1, (B, S))
+        termination_symbol = C - 1
+
+        boundary_ = torch.zeros((B, 4), dtype=torch.int64)
+        boundary_[:, 2] = seq_length
+        boundary_[:, 3] = frames
+
+        for rnnt_type in ["regular", "modified", "constrained"]:
+            for device in self.devices:
+                logits = logits_.to(device).detach().requires_grad_()
+                symbols = symbols_.to(device)
+                boundary = boundary_.to(device)
+
+                px, py = fast_rnnt.get_rnnt_logprobs_joint(
+                    logits=logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                )
+                assert px.dtype == torch.float32, px.dtype
+                assert py.dtype == torch.float32, py.dtype
+
+                half_loss = fast_rnnt.rnnt_loss(
+                    logits=logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                    reduction="none",
+                )
+                float_logits = logits.detach().float().requires_grad_()
+                loss = fast_rnnt.rnnt_loss(
+                    logits=float_logits,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                    reduction="none",
+                )
+                assert torch.allclose(half_loss, loss, atol=1e-2, rtol=1e-3)
+
+                (half_grad,) = torch.autograd.grad(half_loss.sum(), logits)
+                (grad,) = torch.autograd.grad(loss.sum(), float_logits)
+                assert half_grad.dtype == torch.bfloat16, half_grad.dtype
+                assert torch.allclose(half_grad.float(), grad, atol=1e-2)
+
+                # pruned
+                am = am_.to(device)
+                lm = lm_.to(device)
+                _, (px_grad, py_grad) = fast_rnnt.rnnt_loss_simple(
+                    lm=lm,
+                    am=am,
+                    symbols=symbols,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                    return_grad=True,
+                    reduction="none",
+                )
+                ranges = fast_rnnt.get_rnnt_prune_ranges(
+                    px_grad=px_grad,
+                    py_grad=py_grad,
+                    boundary=boundary,
+                    s_range=5,
+                )
+                # (B, T, 5, C)
+                pruned_am, pruned_lm = fast_rnnt.do_rnnt_pruning(
+                    am=am, lm=lm, ranges=ranges
+                )
+                pruned_logits = (pruned_am + pruned_lm).to(torch.bfloat16)
+                pruned_logits.requires_grad_()
+                float_pruned_logits = (
+                    pruned_logits.detach().float().requires_grad_()
+                )
+
+                half_loss = fast_rnnt.rnnt_loss_pruned(
+                    logits=pruned_logits,
+                    symbols=symbols,
+                    ranges=ranges,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                    reduction="none",
+                )
+                loss = fast_rnnt.rnnt_loss_pruned(
+                    logits=float_pruned_logits,
+                    symbols=symbols,
+                    ranges=ranges,
+                    termination_symbol=termination_symbol,
+                    boundary=boundary,
+                    rnnt_type=rnnt_type,
+                    reduction="none",
+                )
+                assert torch.allclose(half_loss, loss, atol=1e-2, rtol=1e-3)
+
+                (half_grad,) = torch.autograd.grad(
+                    half_loss.sum(), pruned_logits
+                )
+                (grad,) = torch.autograd.grad(loss.sum(), float_pruned_logits)
+                assert half_grad.dtype == torch.bfloat16, half_grad.dtype
+                assert torch.allclose(half_grad.float(), grad, atol=1e-2)
+
+    def test_half_logsumexp(self):
+        for device in self.devices:
+            x_ = torch.randn((3, 4, 50), device=device).to(torch.bfloat16)
+            x_[0, 0] = float("-inf")
+            x = x_.detach().requires_grad_()
+            # chunk_size does not divide C, to cover a partial chunk
+            lse = fast_rnnt.rnnt_loss._logsumexp(x, chunk_size=16)
+            float_x = x_.detach().float().requires_grad_()
+            expected = torch.logsumexp(float_x, dim=-1)
+            assert lse.dtype == torch.float32, lse.dtype
+            assert torch.allclose(lse, expected, atol=1e-5)
+
+            lse_grad = torch.randn_like(lse)
+            (x_grad,) = torch.autograd.grad(lse, x, lse_grad)
+            (expected_grad,) = torch.autograd.grad(expected, float_x, lse_grad)
+            assert x_grad.dtype == torch.bfloat16, x_grad.dtype
+            assert torch.allclose(
+                x_grad[1:].float(), expected_grad[1:], atol=1e-2
+            )
+
     def test_rnnt_loss_smoothed(self):
         B = 1
         S = 3
@@ -704,6 +964,85 @@ class TestRnntLoss(unittest.TestCase):
                     ), f"Pruned loss is inf for r={r}, S={S}, T={T}: {pruned_loss}"
                     print(f"Pruned loss with range {r} : {pruned_loss}")
 
+    def _reload_rnnt_loss(self, compile_mode: str):
+        with unittest.mock.patch.dict(
+            os.environ, {"FAST_RNNT_COMPILE": compile_mode}
+        ):
+            importlib.reload(fast_rnnt.rnnt_loss)
+
+    def test_rnnt_loss_compile_mode(self):
+        B = 2
+        S = 4
+        T = 10
+        C = 5
+        logits = torch.randn((B, T, S + 1, C))
+        symbols = torch.randint(0, C - 1, (B, S))
+        termination_symbol = C - 1
+
+        def get_logprobs():
+            return fast_rnnt.rnnt_loss.get_rnnt_logprobs_joint(
+                logits=logits,
+                symbols=symbols,
+                termination_symbol=termination_symbol,
+            )
+
+        # A fake torch.compile() whose compiled functions raise `error`.
+        compile_calls = []
+
+        def fake_compile(error):
+            def _compile(fn, **kwargs):
+                compile_calls.append((fn.__name__, kwargs))
+
+                def compiled(*args, **kwargs):
+                    raise error
+
+                return compiled
+
+            return _compile
+
+        compile_mode = os.environ.get("FAST_RNNT_COMPILE", "0")
+        try:
+            with self.assertRaises(ValueError):
+                self._reload_rnnt_loss("yes")
+
+            self._reload_rnnt_loss("0")
+            px, py = get_logprobs()
+            if not hasattr(torch, "compile"):
+                return
+
+            import torch._dynamo
+
+            self._reload_rnnt_loss("1")
+            compiled_px, compiled_py = get_logprobs()
+            assert torch.allclose(px, compiled_px)
+            assert torch.allclose(py, compiled_py)
+
+            # compile errors fall back to eager mode
+            error = torch._dynamo.exc.TorchDynamoException("compile failed")
+            with unittest.mock.patch.object(
+                torch, "compile", fake_compile(error)
+            ):
+                self._reload_rnnt_loss("static")
+            names = [name for name, _ in compile_calls]
+            assert "get_rnnt_logprobs_joint" in names, names
+            assert "_get_rnnt_logprobs_joint" in names, names
+            for _, kwargs in compile_calls:
+                assert kwargs["dynamic"] is False, kwargs
+            for _ in range(2):
+                eager_px, eager_py = get_logprobs()
+                assert torch.allclose(px, eager_px)
+                assert torch.allclose(py, eager_py)
+
+            # other errors are raised
+            with unittest.mock.patch.object(
+                torch, "compile", fake_compile(RuntimeError("other error"))
+            ):
+                self._reload_rnnt_loss("1")
+            with self.assertRaises(RuntimeError):
+                get_logprobs()
+        finally:
+            self._reload_rnnt_loss(compile_mode)
+
 
 if __name__ == "__main__":
     unittest.main()